@@ -1,15 +1,26 @@
 # checkout_service.py - Production-ready version
 import os
+import ast
+import json
+import uuid
+import hashlib
+import time
+import threading
 import logging
 from contextlib import contextmanager
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
 from psycopg2.extras import RealDictCursor
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+from flask import Flask, request, jsonify, render_template, session, redirect, url_for, make_response
 import stripe
 from dotenv import load_dotenv
 import redis
 from datetime import datetime
 from urllib.parse import urlparse
+from tracing import tracer
+from profiling import profiler
+from recommendations import CoPurchaseIndex
 
 
 # Load environment variables
@@ -26,6 +37,12 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "dev-secret-key")
 
+# Request tracing (opt-in via TRACING_ENABLED, see tracing.py)
+tracer.init_app(app)
+
+# Memory profiling (opt-in via MEMORY_PROFILING_ENABLED / ADMIN_TOKEN, see profiling.py)
+profiler.init_app(app)
+
 # Production vs Development detection
 IS_PRODUCTION = os.getenv('FLASK_ENV') == 'production'
 PORT = int(os.getenv('PORT', 8080 if IS_PRODUCTION else 5000))
@@ -138,72 +155,125 @@ if REDIS_URL:
 #         if conn:
 #             conn.close()
 
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection that remembers which statements it has already PREPAREd"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+        self.announced = False
+
+
+def get_db_params():
+    """Database connection parameters with enhanced SSL handling"""
+    DATABASE_URL = os.getenv('DATABASE_URL')
+    
+    # Determine SSL configuration
+    ssl_mode = os.getenv('DB_SSL_MODE', 'prefer')
+    ssl_cert_file = os.getenv('SSL_CERT_FILE', '/opt/rds-combined-ca-bundle.pem')
+    
+    # Log SSL configuration for debugging
+    logger.info(f"Attempting database connection with SSL mode: {ssl_mode}")
+    
+    if DATABASE_URL:
+        # Parse DATABASE_URL and build connection
+        result = urlparse(DATABASE_URL)
+        
+        # Enhanced connection parameters with SSL
+        conn_params = {
+            'host': result.hostname,
+            'port': result.port or 5432,
+            'database': result.path.lstrip('/'),
+            'user': result.username,
+            'password': result.password,
+        }
+    else:
+        # Individual environment variables approach
+        conn_params = {
+            'host': os.getenv('DB_HOST') or os.getenv('RDS_HOSTNAME'),
+            'port': int(os.getenv('DB_PORT') or os.getenv('RDS_PORT', 5432)),
+            'database': os.getenv('DB_NAME') or os.getenv('RDS_DB_NAME'),
+            'user': os.getenv('DB_USER') or os.getenv('RDS_USERNAME'),
+            'password': os.getenv('DB_PASSWORD') or os.getenv('RDS_PASSWORD'),
+        }
+
+    conn_params.update({
+        'sslmode': ssl_mode,
+        'connect_timeout': 10,
+        'cursor_factory': RealDictCursor,
+        'connection_factory': PooledConnection
+    })
+    
+    # Add SSL certificate if using SSL
+    if ssl_mode in ['require', 'verify-ca', 'verify-full']:
+        if os.path.exists(ssl_cert_file):
+            conn_params['sslrootcert'] = ssl_cert_file
+            logger.info(f"Using SSL certificate: {ssl_cert_file}")
+        else:
+            logger.warning(f"SSL certificate not found: {ssl_cert_file}")
+
+    return conn_params
+
+
+# Connection pool (one per worker process, created lazily after gunicorn forks).
+# gunicorn.conf.py defaults DB_POOL_MAX to its thread count + 1, so every request
+# thread gets a connection and one nested borrow can always make progress.
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 5))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))  # Seconds to wait for a free connection
+_db_pool = {'pool': None, 'pid': None}
+_db_pool_lock = threading.Lock()
+
+class BlockingConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """Opens connections on demand, keeps them all for reuse, and makes borrowers
+    wait for a free one instead of raising PoolError when the pool is exhausted"""
+
+    def __init__(self, maxconn, timeout, *args, **kwargs):
+        # Nothing is opened up front; minconn is raised afterwards because
+        # psycopg2 only keeps a returned connection while len(idle) < minconn
+        super().__init__(0, maxconn, *args, **kwargs)
+        self.minconn = maxconn
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError(f"No database connection free within {self.timeout}s")
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+def get_db_pool():
+    if _db_pool['pool'] is None or _db_pool['pid'] != os.getpid():
+        # Concurrent first requests in a worker must not each build a pool
+        with _db_pool_lock:
+            if _db_pool['pool'] is None or _db_pool['pid'] != os.getpid():
+                _db_pool['pool'] = BlockingConnectionPool(DB_POOL_MAX, DB_POOL_TIMEOUT, **get_db_params())
+                _db_pool['pid'] = os.getpid()
+    return _db_pool['pool']
+
 @contextmanager
 def get_db_connection():
-    """Database connection with enhanced SSL handling"""
+    """Borrow a pooled database connection"""
+    pool = get_db_pool()
     conn = None
+    discard = False
     try:
-        DATABASE_URL = os.getenv('DATABASE_URL')
-        
-        # Determine SSL configuration
-        ssl_mode = os.getenv('DB_SSL_MODE', 'prefer')
-        ssl_cert_file = os.getenv('SSL_CERT_FILE', '/opt/rds-combined-ca-bundle.pem')
-        
-        # Log SSL configuration for debugging
-        logger.info(f"Attempting database connection with SSL mode: {ssl_mode}")
-        
-        if DATABASE_URL:
-            # Parse DATABASE_URL and build connection
-            result = urlparse(DATABASE_URL)
-            
-            # Enhanced connection parameters with SSL
-            conn_params = {
-                'host': result.hostname,
-                'port': result.port or 5432,
-                'database': result.path.lstrip('/'),
-                'user': result.username,
-                'password': result.password,
-                'sslmode': ssl_mode,
-                'connect_timeout': 10,
-                'cursor_factory': RealDictCursor  # ADD THIS LINE
-            }
-            
-            # Add SSL certificate if using SSL
-            if ssl_mode in ['require', 'verify-ca', 'verify-full']:
-                if os.path.exists(ssl_cert_file):
-                    conn_params['sslrootcert'] = ssl_cert_file
-                    logger.info(f"Using SSL certificate: {ssl_cert_file}")
-                else:
-                    logger.warning(f"SSL certificate not found: {ssl_cert_file}")
-            
-            conn = psycopg2.connect(**conn_params)
-            
-        else:
-            # Individual environment variables approach
-            conn_params = {
-                'host': os.getenv('DB_HOST') or os.getenv('RDS_HOSTNAME'),
-                'port': int(os.getenv('DB_PORT') or os.getenv('RDS_PORT', 5432)),
-                'database': os.getenv('DB_NAME') or os.getenv('RDS_DB_NAME'),
-                'user': os.getenv('DB_USER') or os.getenv('RDS_USERNAME'),
-                'password': os.getenv('DB_PASSWORD') or os.getenv('RDS_PASSWORD'),
-                'sslmode': ssl_mode,
-                'connect_timeout': 10,
-                'cursor_factory': RealDictCursor  # ADD THIS LINE TOO
-            }
-            
-            # Add SSL certificate if using SSL
-            if ssl_mode in ['require', 'verify-ca', 'verify-full']:
-                if os.path.exists(ssl_cert_file):
-                    conn_params['sslrootcert'] = ssl_cert_file
-                    logger.info(f"Using SSL certificate: {ssl_cert_file}")
-                else:
-                    logger.warning(f"SSL certificate not found: {ssl_cert_file}")
-            
-            conn = psycopg2.connect(**conn_params)
-        
-        # Log successful connection with SSL status
-        ssl_info = conn.get_dsn_parameters().get('sslmode', 'unknown')
-        logger.info(f"Database connected successfully with SSL mode: {ssl_info}")
+        with tracer.span('db.connect'):
+            conn = pool.getconn()
+
+        if not conn.announced:
+            # Log new connection with SSL status
+            ssl_info = conn.get_dsn_parameters().get('sslmode', 'unknown')
+            logger.info(f"Database connected successfully with SSL mode: {ssl_info}")
+            conn.announced = True
         
         yield conn
         
@@ -216,20 +286,97 @@ def get_db_connection():
             logger.error("SSL/Authentication issue detected. Check:")
             logger.error("1. RDS security groups allow your ECS subnet")
             logger.error("2. RDS parameter group SSL settings")
-            logger.error(f"3. SSL mode is currently: {ssl_mode}")
+            logger.error(f"3. SSL mode is currently: {os.getenv('DB_SSL_MODE', 'prefer')}")
             
-        if conn:
-            conn.rollback()
+        discard = True
         raise
         
     except Exception as e:
         logger.error(f"Unexpected database error: {e}")
-        if conn:
-            conn.rollback()
         raise
     finally:
         if conn:
-            conn.close()
+            try:
+                # Never hand an open transaction to the next borrower
+                if not conn.closed:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+            pool.putconn(conn, close=discard or bool(conn.closed))
+
+# Server-side prepared statements for the hot queries.
+# Written with %s placeholders; $n parameters are derived for PREPARE.
+PREPARED_STATEMENTS = {
+    'price_map': ('SELECT slug, name, price FROM products', ()),
+    'home_prices': ('SELECT slug, price FROM products ORDER BY name', ()),
+    'catalog': ('''
+        SELECT slug, name, price, description, image_url, 
+               origin_country, brand, material, category, rating, 
+               in_stock, release_date, warranty_months, weight_grams 
+        FROM products WHERE in_stock = true
+        ORDER BY name
+    ''', ()),
+    'cart_prices': ('SELECT slug, price FROM products WHERE slug = ANY(%s)', ('text[]',)),
+    'insert_transaction': ('''
+        INSERT INTO transactions (
+            customer_name, customer_email, total_price, status,
+            address, city, state, zip, country, stripe_charge_id
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        RETURNING id
+    ''', ('text', 'text', 'integer', 'text', 'text', 'text', 'text', 'text', 'text', 'text')),
+    'insert_transaction_item': ('''
+        INSERT INTO transaction_items (transaction_id, product_slug, quantity, price_at_purchase)
+        VALUES (%s, %s, %s, %s)
+    ''', ('integer', 'text', 'integer', 'integer')),
+    'receipt_transaction': ('''
+        SELECT customer_name, customer_email, total_price, address, city, state, zip, country
+        FROM transactions
+        WHERE id = %s
+    ''', ('integer',)),
+    'receipt_items': ('''
+        SELECT product_slug, quantity, price_at_purchase
+        FROM transaction_items
+        WHERE transaction_id = %s
+    ''', ('integer',)),
+}
+
+# Set DB_PREPARE_STATEMENTS=false behind a transaction-mode pooler (e.g. pgbouncer)
+DB_PREPARE_STATEMENTS = os.getenv('DB_PREPARE_STATEMENTS', 'true').lower() == 'true'
+_statement_stats = {name: {'executions': 0, 'prepares': 0} for name in PREPARED_STATEMENTS}
+_statement_stats_lock = threading.Lock()
+
+def _to_positional(sql):
+    """Rewrite %s placeholders as $1, $2, ... for PREPARE"""
+    parts = sql.split('%s')
+    return ''.join(part + (f'${i}' if i < len(parts) else '') for i, part in enumerate(parts, 1))
+
+def execute_statement(cur, name, params=()):
+    """Execute a registered hot query, PREPAREing it once per pooled connection"""
+    sql, param_types = PREPARED_STATEMENTS[name]
+    conn = cur.connection
+
+    if not DB_PREPARE_STATEMENTS or not isinstance(conn, PooledConnection):
+        cur.execute(sql, params)
+    else:
+        if name not in conn.prepared_statements:
+            types = f"({', '.join(param_types)})" if param_types else ''
+            cur.execute(f"PREPARE {name}{types} AS {_to_positional(sql)}")
+            conn.prepared_statements.add(name)
+            with _statement_stats_lock:
+                _statement_stats[name]['prepares'] += 1
+
+        if params:
+            cur.execute(f"EXECUTE {name}({', '.join(['%s'] * len(params))})", params)
+        else:
+            cur.execute(f"EXECUTE {name}")
+
+    with _statement_stats_lock:
+        _statement_stats[name]['executions'] += 1
+
+def get_statement_stats():
+    with _statement_stats_lock:
+        return {name: dict(stats) for name, stats in _statement_stats.items()}
 
 # Alternative: Simple environment-based SSL configuration
 def get_ssl_mode():
@@ -331,13 +478,36 @@ def version():
         "port": PORT
     })
 
+@app.route('/db-stats')
+def db_stats():
+    """Per-statement execution counts for this worker process"""
+    return jsonify({
+        "pid": os.getpid(),
+        "prepared_statements_enabled": DB_PREPARE_STATEMENTS,
+        "statements": get_statement_stats()
+    })
+
 # Enhanced cart management (Redis-aware)
+CART_TTL_SECONDS = 3600  # 1 hour expiry
+CART_OPS = ('add', 'remove', 'set')
+MAX_CART_QUANTITY = int(os.getenv('MAX_CART_QUANTITY', 99))  # Per line item
+
+def _load_cart(raw):
+    """Decode a stored cart (JSON, or the legacy repr format)"""
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return ast.literal_eval(raw)
+
 def get_cart():
     """Get cart from Redis or session"""
     if redis_client and 'user_id' in session:
         try:
-            cart_data = redis_client.get(f"cart:{session['user_id']}")
-            return eval(cart_data) if cart_data else {}
+            with tracer.span('redis.get', key='cart'):
+                cart_data = redis_client.get(f"cart:{session['user_id']}")
+            return _load_cart(cart_data)
         except Exception as e:
             logger.warning(f"Redis cart retrieval failed: {e}")
     
@@ -347,13 +517,356 @@ def save_cart(cart):
     """Save cart to Redis or session"""
     if redis_client and 'user_id' in session:
         try:
-            redis_client.setex(f"cart:{session['user_id']}", 3600, str(cart))  # 1 hour expiry
+            with tracer.span('redis.setex', key='cart'):
+                redis_client.setex(f"cart:{session['user_id']}", CART_TTL_SECONDS, json.dumps(cart))
             return
         except Exception as e:
             logger.warning(f"Redis cart save failed: {e}")
     
     session['cart'] = cart
 
+# Applies a validated list of cart operations in a single atomic round trip.
+# Semantics must stay in sync with apply_cart_ops() below.
+CART_BATCH_SCRIPT = """
+local raw = redis.call('GET', KEYS[1])
+local cart = {}
+if raw then
+    local ok, decoded = pcall(cjson.decode, raw)
+    if not ok then
+        return redis.error_reply('LEGACY_CART')
+    end
+    cart = decoded
+end
+local ops = cjson.decode(ARGV[1])
+for _, op in ipairs(ops) do
+    local current = tonumber(cart[op.item]) or 0
+    local new_qty
+    if op.op == 'add' then
+        new_qty = current + op.quantity
+    elseif op.op == 'remove' then
+        new_qty = current - op.quantity
+    else
+        new_qty = op.quantity
+    end
+    if new_qty > 0 then
+        cart[op.item] = math.min(new_qty, tonumber(ARGV[3]))
+    else
+        cart[op.item] = nil
+    end
+end
+local encoded = '{}'
+if next(cart) ~= nil then
+    encoded = cjson.encode(cart)
+end
+redis.call('SETEX', KEYS[1], ARGV[2], encoded)
+return encoded
+"""
+cart_batch_script = redis_client.register_script(CART_BATCH_SCRIPT) if redis_client else None
+
+def apply_cart_ops(cart, ops):
+    """Apply validated cart operations to a cart dict in place"""
+    for op in ops:
+        current = cart.get(op['item'], 0)
+        if op['op'] == 'add':
+            new_qty = current + op['quantity']
+        elif op['op'] == 'remove':
+            new_qty = current - op['quantity']
+        else:
+            new_qty = op['quantity']
+
+        if new_qty > 0:
+            cart[op['item']] = min(new_qty, MAX_CART_QUANTITY)
+        else:
+            cart.pop(op['item'], None)
+    return cart
+
+def apply_cart_batch(ops):
+    """Apply cart operations atomically (one Redis call) with session fallback"""
+    if cart_batch_script and 'user_id' in session:
+        try:
+            with tracer.span('redis.cart_batch', operations=len(ops)):
+                encoded = cart_batch_script(
+                    keys=[f"cart:{session['user_id']}"],
+                    args=[json.dumps(ops), CART_TTL_SECONDS, MAX_CART_QUANTITY]
+                )
+            return json.loads(encoded)
+        except Exception as e:
+            logger.warning(f"Redis cart batch failed, applying in-process: {e}")
+
+    cart = apply_cart_ops(get_cart(), ops)
+    save_cart(cart)
+    return cart
+
+# Cached price map (per worker) so cart pricing doesn't hit the database
+PRICE_CACHE_TTL = int(os.getenv('PRICE_CACHE_TTL', 60))
+_price_cache = {'products': None, 'loaded_at': 0.0}
+
+def get_price_map():
+    """Return {slug: {'name', 'price'}} from a short-lived in-process cache"""
+    now = time.monotonic()
+    if _price_cache['products'] is None or now - _price_cache['loaded_at'] > PRICE_CACHE_TTL:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur, tracer.span('db.query', statement='price_map'):
+                execute_statement(cur, 'price_map')
+                _price_cache['products'] = {
+                    row['slug']: {'name': row['name'], 'price': row['price']}
+                    for row in cur.fetchall()
+                }
+        _price_cache['loaded_at'] = now
+    return _price_cache['products']
+
+def price_cart(cart, products):
+    """Build line items and totals (integer cents) for a cart"""
+    line_items = []
+    total = 0
+    for slug, qty in cart.items():
+        product = products.get(slug)
+        if not product:
+            continue
+        subtotal = product['price'] * qty
+        total += subtotal
+        line_items.append({
+            'item': slug,
+            'name': product['name'],
+            'quantity': qty,
+            'unit_price': product['price'],
+            'subtotal': subtotal
+        })
+    return {'items': line_items, 'total': total, 'currency': 'usd'}
+
+def parse_cart_ops(raw_ops, products):
+    """Validate a list of cart operations, returning (ops, error_message)"""
+    if not isinstance(raw_ops, list) or not raw_ops:
+        return None, 'Operations must be a non-empty list'
+
+    ops = []
+    for raw in raw_ops:
+        if not isinstance(raw, dict):
+            return None, 'Invalid operation'
+        op = raw.get('op')
+        item = raw.get('item')
+        if not isinstance(op, str) or op not in CART_OPS:
+            return None, f'Unknown operation: {op}'
+        if not isinstance(item, str) or item not in products:
+            return None, f'Invalid item: {item}'
+        quantity = raw.get('quantity', 1)
+        # bool is an int subclass; floats and strings aren't silently truncated either
+        if not isinstance(quantity, int) or isinstance(quantity, bool):
+            return None, 'Quantity must be an integer'
+        if quantity < 0 or (quantity == 0 and op != 'set'):
+            return None, 'Quantity must be positive'
+        if quantity > MAX_CART_QUANTITY:
+            return None, f'Quantity must be at most {MAX_CART_QUANTITY}'
+        ops.append({'op': op, 'item': item, 'quantity': quantity})
+    return ops, None
+
+# "Frequently bought together" index (Redis sorted sets, or per-worker memory without Redis)
+copurchase_index = CoPurchaseIndex(redis_client)
+
+@contextmanager
+def get_dedicated_db_connection():
+    """A connection outside the pool, for long-running background work"""
+    conn = psycopg2.connect(**get_db_params())
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def start_recommendation_refresher():
+    """Build/refresh the index in a background thread of this worker (no-op if running)"""
+    copurchase_index.start_refresher(get_dedicated_db_connection)
+
+def get_recommendations(items, exclude=()):
+    """Related products for the given slugs, priced from the cached price map.
+
+    Only reads the index; building it happens in the background refresher.
+    """
+    try:
+        start_recommendation_refresher()
+        products = get_price_map()
+        return [
+            {'item': slug, 'name': products[slug]['name'], 'price': products[slug]['price'], 'score': score}
+            for slug, score in copurchase_index.related(items, exclude=exclude)
+            if slug in products
+        ]
+    except Exception as e:
+        logger.warning(f"Recommendations unavailable: {e}")
+        return []
+
+# Idempotent checkout - one outcome per key, stored in Redis (or Postgres without Redis)
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', 86400))   # Replay window
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv('IDEMPOTENCY_LOCK_SECONDS', 150))   # In-flight lock, extended while running
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', 20))  # Duplicate waits this long for the original
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+
+def get_idempotency_key(data):
+    """Client key (Idempotency-Key header / form field) plus the payment token, scoped to the session.
+
+    Stripe tokens are single-use, so a token identifies one payment attempt: a resubmit
+    of the same form replays, while another card (e.g. after a decline, from a page
+    restored with the same client key) gets a fresh key. Keys are hashed, so the same
+    value also works as the Stripe key. The cart isn't part of the key because it is
+    cleared on success; it is checked as a fingerprint instead (see cart_fingerprint).
+    """
+    client_key = (request.headers.get('Idempotency-Key') or data.get('idempotency_key') or '').strip()
+    token = data.get('payment_token') or ''
+    if not client_key and not token:
+        return None
+    raw = f"{client_key[:IDEMPOTENCY_KEY_MAX_LENGTH]}:token:{token}"
+    return hashlib.sha256(f"{session.get('user_id', '')}:{raw}".encode('utf-8')).hexdigest()
+
+def cart_fingerprint(cart):
+    return hashlib.sha256(json.dumps(cart, sort_keys=True).encode('utf-8')).hexdigest()
+
+EMPTY_CART_FINGERPRINT = cart_fingerprint({})
+
+def claim_idempotency_key(key, fingerprint):
+    """Take the in-flight lock for a key; returns (claimed, existing_record)"""
+    record = {'state': 'in_flight', 'fingerprint': fingerprint}
+    if redis_client:
+        try:
+            if redis_client.set(f"idem:{key}", json.dumps(record), nx=True, ex=IDEMPOTENCY_LOCK_SECONDS):
+                return True, None
+            return False, get_idempotency_record(key)
+        except Exception as e:
+            logger.warning(f"Redis idempotency claim failed, using database: {e}")
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            # Insert, or take over a key whose lock/replay window has expired
+            cur.execute("""
+                INSERT INTO idempotency_keys (key, state, fingerprint, expires_at)
+                VALUES (%s, 'in_flight', %s, NOW() + %s * INTERVAL '1 second')
+                ON CONFLICT (key) DO UPDATE
+                    SET state = 'in_flight', fingerprint = EXCLUDED.fingerprint,
+                        response = NULL, expires_at = EXCLUDED.expires_at
+                    WHERE idempotency_keys.expires_at < NOW()
+                RETURNING key
+            """, (key, fingerprint, IDEMPOTENCY_LOCK_SECONDS))
+            claimed = cur.fetchone() is not None
+        conn.commit()
+    return (True, None) if claimed else (False, get_idempotency_record(key))
+
+def get_idempotency_record(key):
+    if redis_client:
+        try:
+            raw = redis_client.get(f"idem:{key}")
+            return json.loads(raw) if raw else None
+        except Exception as e:
+            logger.warning(f"Redis idempotency lookup failed, using database: {e}")
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT state, fingerprint, response FROM idempotency_keys
+                WHERE key = %s AND expires_at >= NOW()
+            """, (key,))
+            row = cur.fetchone()
+    if not row:
+        return None
+    return {'state': row['state'], 'fingerprint': row['fingerprint'], 'response': row['response']}
+
+def extend_idempotency_lock(key):
+    """Push out the in-flight lock's expiry while the original request is still running"""
+    if redis_client:
+        try:
+            redis_client.expire(f"idem:{key}", IDEMPOTENCY_LOCK_SECONDS)
+            return
+        except Exception as e:
+            logger.warning(f"Redis idempotency lock extension failed, using database: {e}")
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE idempotency_keys SET expires_at = NOW() + %s * INTERVAL '1 second'
+                WHERE key = %s AND state = 'in_flight'
+            """, (IDEMPOTENCY_LOCK_SECONDS, key))
+        conn.commit()
+
+def hold_idempotency_lock(key, done):
+    """Background heartbeat for a claimed key, until `done` is set"""
+    def heartbeat():
+        while not done.wait(IDEMPOTENCY_LOCK_SECONDS / 3):
+            try:
+                extend_idempotency_lock(key)
+            except Exception as e:
+                logger.warning(f"Idempotency lock extension failed: {e}")
+    thread = threading.Thread(target=heartbeat, name='idempotency-lock', daemon=True)
+    thread.start()
+    return thread
+
+def finish_idempotency_key(key, fingerprint, response):
+    """Store the outcome for replay, or release the key so a retry can run again"""
+    try:
+        # Only orders (2xx/3xx) are final. Server-side failures (and crashes) can be retried,
+        # since the Stripe idempotency key keeps a retry from charging twice; client errors
+        # (missing fields, declined card) are released so the customer can correct them
+        if response is None or response.status_code >= 400:
+            if redis_client:
+                try:
+                    redis_client.delete(f"idem:{key}")
+                    return
+                except Exception as e:
+                    logger.warning(f"Redis idempotency release failed, using database: {e}")
+            with get_db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM idempotency_keys WHERE key = %s", (key,))
+                conn.commit()
+            return
+
+        stored = {'status': response.status_code}
+        if response.status_code in (301, 302, 303):
+            stored['location'] = response.headers.get('Location')
+        elif response.is_json:
+            stored['json'] = response.get_json()
+        else:
+            stored['text'] = response.get_data(as_text=True)
+        record = {'state': 'done', 'fingerprint': fingerprint, 'response': stored}
+
+        if redis_client:
+            try:
+                redis_client.set(f"idem:{key}", json.dumps(record), ex=IDEMPOTENCY_TTL_SECONDS)
+                return
+            except Exception as e:
+                logger.warning(f"Redis idempotency store failed, using database: {e}")
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE idempotency_keys
+                    SET state = 'done', response = %s, expires_at = NOW() + %s * INTERVAL '1 second'
+                    WHERE key = %s
+                """, (json.dumps(stored), IDEMPOTENCY_TTL_SECONDS, key))
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Failed to record idempotent checkout outcome: {e}")
+
+def replay_idempotent_response(key, record, fingerprint):
+    """Wait for an in-flight original, then replay its response"""
+    # After a successful order the cart is empty, so only a different non-empty cart is a mismatch
+    if record and fingerprint != EMPTY_CART_FINGERPRINT and record.get('fingerprint') != fingerprint:
+        return jsonify({"status": "failure", "message": "Idempotency key reused with a different cart"}), 422
+
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    with tracer.span('idempotency.wait'):
+        while record and record.get('state') == 'in_flight' and time.monotonic() < deadline:
+            time.sleep(0.25)
+            record = get_idempotency_record(key)
+
+    if record is None:
+        # The original failed and released the key; the client can safely retry
+        return jsonify({"status": "failure", "message": "Previous attempt failed, please retry"}), 409
+    if record.get('state') == 'in_flight':
+        response = jsonify({"status": "processing", "message": "Order is still being processed"})
+        response.headers['Retry-After'] = '5'
+        return response, 409
+
+    stored = record['response']
+    logger.info(f"Replaying checkout outcome for idempotency key {key[:12]}")
+    if stored.get('location'):
+        return redirect(stored['location'], code=stored['status'])
+    if 'json' in stored:
+        return jsonify(stored['json']), stored['status']
+    return stored.get('text', ''), stored['status']
+
 # Your original routes (with enhancements)
 @app.route('/')
 def home():
@@ -365,23 +878,22 @@ def home():
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute('SELECT slug, price FROM products ORDER BY name')
-                items = {row['slug']: row['price'] for row in cur.fetchall()}
-
-                cur.execute('''
-                    SELECT slug, name, price, description, image_url, 
-                           origin_country, brand, material, category, rating, 
-                           in_stock, release_date, warranty_months, weight_grams 
-                    FROM products WHERE in_stock = true
-                    ORDER BY name
-                ''')
-                coffee_items = {row['slug']: dict(row) for row in cur.fetchall()}
-
-            cart = get_cart()
-            return render_template('index.html', 
-                                 items=items, 
-                                 cart=cart, 
-                                 coffee_items=coffee_items)
+                with tracer.span('db.query', statement='home_prices'):
+                    execute_statement(cur, 'home_prices')
+                    items = {row['slug']: row['price'] for row in cur.fetchall()}
+
+                with tracer.span('db.query', statement='catalog'):
+                    execute_statement(cur, 'catalog')
+                    coffee_items = {row['slug']: dict(row) for row in cur.fetchall()}
+
+        # After the connection is returned, as the price map may need one of its own
+        cart = get_cart()
+        recommendations = get_recommendations(cart.keys()) if cart else []
+        return render_template('index.html', 
+                             items=items, 
+                             cart=cart, 
+                             coffee_items=coffee_items,
+                             recommendations=recommendations)
                                  
     except Exception as e:
         logger.error(f"Error in home route: {e}")
@@ -444,13 +956,7 @@ def api_add_to_cart():
         item = data.get('item')
         quantity = int(data.get('quantity', 1))
 
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute('SELECT slug, name, price FROM products')
-                all_products = {
-                    row['slug']: {'name': row['name'], 'price': row['price']}
-                    for row in cur.fetchall()
-                }
+        all_products = get_price_map()
 
         if item not in all_products:
             return jsonify({'status': 'error', 'message': 'Invalid item'}), 400
@@ -469,6 +975,38 @@ def api_add_to_cart():
 @app.route('/checkout', methods=['GET', 'POST'])
 def checkout():
     cart = get_cart()
+    if request.method == 'GET':
+        return process_checkout(cart)
+
+    # POST - retries (user, browser or proxy after a timeout) replay the first outcome
+    idempotency_key = get_idempotency_key(request.form)
+    if not idempotency_key:
+        return process_checkout(cart)
+
+    fingerprint = cart_fingerprint(cart)
+    try:
+        with tracer.span('idempotency.claim'):
+            claimed, record = claim_idempotency_key(idempotency_key, fingerprint)
+        if not claimed:
+            return replay_idempotent_response(idempotency_key, record, fingerprint)
+    except Exception as e:
+        # Without Redis this needs the idempotency_keys table from init.sql
+        logger.error(f"Error in checkout idempotency check: {e}")
+        return jsonify({"status": "failure", "message": "Internal server error"}), 500
+
+    response = None
+    done = threading.Event()
+    heartbeat = hold_idempotency_lock(idempotency_key, done)
+    try:
+        response = make_response(process_checkout(cart, idempotency_key))
+    finally:
+        # Stop the heartbeat first so it can't shorten the stored outcome's expiry
+        done.set()
+        heartbeat.join()
+        finish_idempotency_key(idempotency_key, fingerprint, response)
+    return response
+
+def process_checkout(cart, idempotency_key=None):
     if not cart:
         return "Cart is empty", 400
 
@@ -479,10 +1017,9 @@ def checkout():
                     cart_items = []
                     total = 0
 
-                    placeholders = ','.join(['%s'] * len(cart))
-                    cur.execute(f"SELECT slug, price FROM products WHERE slug IN ({placeholders})", 
-                              list(cart.keys()))
-                    prices = {row['slug']: row['price'] for row in cur.fetchall()}
+                    with tracer.span('db.query', statement='cart_prices'):
+                        execute_statement(cur, 'cart_prices', (list(cart.keys()),))
+                        prices = {row['slug']: row['price'] for row in cur.fetchall()}
 
                     for slug, qty in cart.items():
                         price = prices.get(slug, 0)
@@ -498,7 +1035,8 @@ def checkout():
                     return render_template("checkout.html", 
                                          items=cart_items, 
                                          total=total / 100.0, 
-                                         stripe_public_key=STRIPE_PUBLISHABLE_KEY)
+                                         stripe_public_key=STRIPE_PUBLISHABLE_KEY,
+                                         idempotency_key=uuid.uuid4().hex)
 
                 # POST - process payment
                 data = request.form
@@ -507,20 +1045,21 @@ def checkout():
                 if not all(data.get(field) for field in required_fields):
                     return jsonify({"status": "failure", "message": "Missing required fields"}), 400
 
-                placeholders = ','.join(['%s'] * len(cart))
-                cur.execute(f"SELECT slug, price FROM products WHERE slug IN ({placeholders})", 
-                          list(cart.keys()))
-                prices = {row['slug']: row['price'] for row in cur.fetchall()}
+                with tracer.span('db.query', statement='cart_prices'):
+                    execute_statement(cur, 'cart_prices', (list(cart.keys()),))
+                    prices = {row['slug']: row['price'] for row in cur.fetchall()}
                 total_amount = sum(prices.get(slug, 0) * qty for slug, qty in cart.items())
 
                 try:
-                    charge = stripe.Charge.create(
-                        amount=total_amount,
-                        currency="usd",
-                        source=data.get("payment_token"),
-                        description=f"Order from {data.get('full_name')}",
-                        receipt_email=data.get("email")
-                    )
+                    with tracer.span('stripe.charge.create', amount=total_amount):
+                        charge = stripe.Charge.create(
+                            amount=total_amount,
+                            currency="usd",
+                            source=data.get("payment_token"),
+                            description=f"Order from {data.get('full_name')}",
+                            receipt_email=data.get("email"),
+                            idempotency_key=idempotency_key  # Stripe returns the same charge on retries
+                        )
                     logger.info(f"Stripe charge successful: {charge.id}")
                 except stripe.error.StripeError as e:
                     logger.error(f"Stripe error: {e}")
@@ -528,39 +1067,39 @@ def checkout():
 
                 # Save to database
                 try:
-                    cur.execute("""
-                        INSERT INTO transactions (
-                            customer_name, customer_email, total_price, status,
-                            address, city, state, zip, country
-                        )
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        RETURNING id
-                    """, (
-                        data.get("full_name"), data.get("email"), total_amount, 'completed',
-                        data.get("address"), data.get("city"), data.get("state"), 
-                        data.get("zip"), data.get("country")
-                    ))
-
-                    row = cur.fetchone()
-                    transaction_id = row['id'] if row else None
-
-                    for slug, qty in cart.items():
-                        price_at_purchase = prices.get(slug, 0)
-                        cur.execute("""
-                            INSERT INTO transaction_items (transaction_id, product_slug, quantity, price_at_purchase)
-                            VALUES (%s, %s, %s, %s)
-                        """, (transaction_id, slug, qty, price_at_purchase))
-
-                    conn.commit()
+                    with tracer.span('db.query', statement='insert_transaction'):
+                        execute_statement(cur, 'insert_transaction', (
+                            data.get("full_name"), data.get("email"), total_amount, 'completed',
+                            data.get("address"), data.get("city"), data.get("state"), 
+                            data.get("zip"), data.get("country"), charge.id
+                        ))
+
+                        row = cur.fetchone()
+                        transaction_id = row['id'] if row else None
+
+                    with tracer.span('db.query', statement='insert_transaction_items', rows=len(cart)):
+                        for slug, qty in cart.items():
+                            price_at_purchase = prices.get(slug, 0)
+                            execute_statement(cur, 'insert_transaction_item',
+                                              (transaction_id, slug, qty, price_at_purchase))
+
+                    with tracer.span('db.commit'):
+                        conn.commit()
                     
                     # Clear cart from Redis/session
                     if redis_client and 'user_id' in session:
                         try:
-                            redis_client.delete(f"cart:{session['user_id']}")
+                            with tracer.span('redis.delete', key='cart'):
+                                redis_client.delete(f"cart:{session['user_id']}")
                         except:
                             pass
                     session.pop('cart', None)
                     
+                    try:
+                        copurchase_index.record_order(cart.keys())
+                    except Exception as e:
+                        logger.warning(f"Co-purchase index update failed: {e}")
+                    
                     logger.info(f"Order completed: Transaction {transaction_id}")
                     return redirect(url_for('receipt', transaction_id=transaction_id))
                     
@@ -583,14 +1122,8 @@ def api_remove_from_cart():
         if not item:
             return jsonify({'status': 'error', 'message': 'Item is required'}), 400
 
-        # Get all products from database (same as add-to-cart)
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute('SELECT slug, name, price FROM products')
-                all_products = {
-                    row['slug']: {'name': row['name'], 'price': row['price']}
-                    for row in cur.fetchall()
-                }
+        # Get all products from the cached price map (same as add-to-cart)
+        all_products = get_price_map()
 
         if item not in all_products:
             return jsonify({'status': 'error', 'message': 'Invalid item'}), 400
@@ -616,28 +1149,55 @@ def api_remove_from_cart():
         logger.error(f"Error in remove_from_cart: {e}")
         return jsonify({'status': 'error', 'message': 'Internal server error'}), 500
 
+@app.route('/api/cart', methods=['GET'])
+def api_cart():
+    """Priced cart (line items, subtotals, total in cents) from the cached price map"""
+    try:
+        cart = get_cart()
+        return jsonify({'status': 'success', 'cart': cart, **price_cart(cart, get_price_map())})
+
+    except Exception as e:
+        logger.error(f"Error in cart: {e}")
+        return jsonify({'status': 'error', 'message': 'Internal server error'}), 500
+
+@app.route('/api/cart/batch', methods=['POST'])
+def api_cart_batch():
+    """Apply a list of add/remove/set operations to the cart in one request"""
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'status': 'error', 'message': 'Request body must be a JSON object'}), 400
+        products = get_price_map()
+
+        ops, error = parse_cart_ops(data.get('operations'), products)
+        if error:
+            return jsonify({'status': 'error', 'message': error}), 400
+
+        cart = apply_cart_batch(ops)
+
+        logger.info(f"Cart batch applied: {len(ops)} operation(s)")
+        return jsonify({'status': 'success', 'cart': cart, **price_cart(cart, products)})
+
+    except Exception as e:
+        logger.error(f"Error in cart batch: {e}")
+        return jsonify({'status': 'error', 'message': 'Internal server error'}), 500
+
 
 @app.route('/receipt/<int:transaction_id>')
 def receipt(transaction_id):
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT customer_name, customer_email, total_price, address, city, state, zip, country
-                    FROM transactions
-                    WHERE id = %s
-                """, (transaction_id,))
-                tx = cur.fetchone()
+                with tracer.span('db.query', statement='receipt_transaction'):
+                    execute_statement(cur, 'receipt_transaction', (transaction_id,))
+                    tx = cur.fetchone()
 
                 if not tx:
                     return "Transaction not found", 404
 
-                cur.execute("""
-                    SELECT product_slug, quantity, price_at_purchase
-                    FROM transaction_items
-                    WHERE transaction_id = %s
-                """, (transaction_id,))
-                items_raw = cur.fetchall()
+                with tracer.span('db.query', statement='receipt_items'):
+                    execute_statement(cur, 'receipt_items', (transaction_id,))
+                    items_raw = cur.fetchall()
 
         items = []
         for row in items_raw:
@@ -663,20 +1223,37 @@ def receipt(transaction_id):
         logger.error(f"Error in receipt route: {e}")
         return "Internal server error", 500
 
+@app.route('/item/<slug>')
+def item_detail(slug):
+    try:
+        products = get_price_map()
+        if slug not in products:
+            return "Item not found", 404
+
+        return render_template("item_detail.html",
+                               slug=slug,
+                               name=products[slug]['name'],
+                               price=products[slug]['price'],
+                               recommendations=get_recommendations([slug]))
+    except Exception as e:
+        logger.error(f"Error in item route: {e}")
+        return "Internal server error", 500
+
 # API endpoints
+@app.route('/api/recommendations')
+def api_recommendations():
+    """Frequently bought together for ?item=<slug> (repeatable), or the current cart"""
+    items = request.args.getlist('item') or list(get_cart().keys())
+    return jsonify({'items': items, 'recommendations': get_recommendations(items)})
+
 @app.route('/api/products')
 def api_products():
     """Products API endpoint"""
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute('''
-                    SELECT slug, name, price, description, image_url, 
-                           origin_country, brand, material, category, rating, 
-                           in_stock, release_date, warranty_months, weight_grams 
-                    FROM products
-                    WHERE in_stock = true
-                ''')
+                with tracer.span('db.query', statement='catalog'):
+                    execute_statement(cur, 'catalog')
                 products = {row['slug']: dict(row) for row in cur.fetchall()}
         
         return jsonify({'products': products})
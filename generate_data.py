@@ -0,0 +1,321 @@
+# generate_data.py - Synthetic scale dataset generator (products, transactions, line items)
+#
+# Usage:
+#   python generate_data.py --products 100000 --transactions 10000000 --seed 42 --truncate
+#
+# Rows are streamed into Postgres with COPY in chunks. The foreign keys and secondary
+# indexes on the order tables are dropped for the load and rebuilt once at the end,
+# all inside a single transaction, so a failed run leaves the database unchanged.
+import os
+import io
+import sys
+import time
+import math
+import random
+import argparse
+from datetime import date, datetime, timedelta
+import psycopg2
+import psycopg2.errors
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Category -> (median price in cents, materials, typical weight in grams, warranty months)
+CATEGORIES = {
+    'Appliance': (15000, ['Stainless Steel', 'Aluminum', 'Plastic'], 4000, 24),
+    'Grinder': (9000, ['Stainless Steel', 'Ceramic', 'Plastic'], 1800, 24),
+    'Brewer': (4500, ['Glass', 'Stainless Steel', 'Plastic'], 900, 12),
+    'Kettle': (6000, ['Stainless Steel', 'Copper'], 1100, 12),
+    'Accessory': (2500, ['Stainless Steel', 'Silicone', 'Wood', 'Plastic'], 300, 6),
+    'Coffee': (1800, ['N/A'], 340, 0),
+    'Filter': (800, ['Paper', 'Cloth', 'Stainless Steel'], 100, 0),
+    'Drinkware': (1500, ['Ceramic', 'Glass', 'Stainless Steel'], 350, 0),
+    'Subscription': (3000, ['N/A'], 1, 0),
+}
+BRANDS = ['BrewMaster', 'CafeTech', 'BeanBox', 'Roastery', 'PourOver Co', 'Barista Pro',
+          'Morning Ritual', 'Crema', 'Kettle & Co', 'Origin Labs', 'Grindhouse', 'Steamline']
+COUNTRIES = ['Italy', 'Germany', 'Japan', 'USA', 'Colombia', 'Ethiopia', 'Brazil', 'Vietnam', 'Kenya']
+ADJECTIVES = ['Classic', 'Pro', 'Mini', 'Deluxe', 'Smart', 'Artisan', 'Compact', 'Signature', 'Ultra']
+
+FIRST_NAMES = ['Alex', 'Sam', 'Jordan', 'Taylor', 'Minh', 'Linh', 'Chris', 'Pat', 'Jamie', 'Morgan',
+               'Casey', 'Riley', 'Quinn', 'Avery', 'Duc', 'Hoa', 'Lee', 'Robin', 'Drew', 'Kai']
+LAST_NAMES = ['Nguyen', 'Smith', 'Tran', 'Johnson', 'Le', 'Brown', 'Pham', 'Garcia', 'Miller', 'Davis',
+              'Hoang', 'Wilson', 'Vu', 'Moore', 'Anderson', 'Do', 'Clark', 'Lewis', 'Walker', 'Hall']
+CITIES = [('Seattle', 'WA', '98101', 'US'), ('Austin', 'TX', '73301', 'US'), ('Boston', 'MA', '02108', 'US'),
+          ('Denver', 'CO', '80202', 'US'), ('Chicago', 'IL', '60601', 'US'), ('Miami', 'FL', '33101', 'US'),
+          ('Hanoi', 'HN', '100000', 'VN'), ('Ho Chi Minh City', 'SG', '700000', 'VN'),
+          ('Da Nang', 'DN', '550000', 'VN'), ('Fairfax', 'VA', '22030', 'US')]
+STREETS = ['Main St', 'Oak Ave', 'Pine Rd', 'Maple Dr', 'Cedar Ln', 'Elm St', 'Le Loi', 'Tran Hung Dao']
+
+STATUSES = ['completed', 'pending', 'failed', 'refunded']
+STATUS_WEIGHTS = [92, 3, 3, 2]
+ITEMS_PER_ORDER_WEIGHTS = [45, 25, 13, 7, 4, 3, 2, 1]  # 1..8 distinct products per order
+QUANTITY_WEIGHTS = [80, 13, 4, 2, 1]                    # 1..5 units per line
+SAME_CATEGORY_PROBABILITY = 0.6                         # Basket affinity for later line items
+
+ORDER_TABLE_INDEXES = {
+    'idx_transactions_status': 'CREATE INDEX idx_transactions_status ON transactions(status)',
+    'idx_transactions_email': 'CREATE INDEX idx_transactions_email ON transactions(customer_email)',
+    'idx_transactions_stripe': 'CREATE INDEX idx_transactions_stripe ON transactions(stripe_charge_id)',
+    'idx_items_transaction': 'CREATE INDEX idx_items_transaction ON transaction_items(transaction_id)',
+}
+ORDER_TABLE_FOREIGN_KEYS = {
+    'transaction_items_transaction_id_fkey':
+        'FOREIGN KEY (transaction_id) REFERENCES transactions(id) ON DELETE CASCADE',
+    'transaction_items_product_slug_fkey':
+        'FOREIGN KEY (product_slug) REFERENCES products(slug)',
+}
+
+
+def get_dsn(args):
+    """--dsn, then DATABASE_URL, then the POSTGRES_* variables used by docker-compose"""
+    if args.dsn:
+        return args.dsn
+    if os.getenv('DATABASE_URL'):
+        return os.getenv('DATABASE_URL')
+    return (f"host={os.getenv('POSTGRES_HOST', 'localhost')} "
+            f"port={os.getenv('POSTGRES_PORT', 5432)} "
+            f"dbname={os.getenv('POSTGRES_DB', 'checkout_service')} "
+            f"user={os.getenv('POSTGRES_USER', 'postgres')} "
+            f"password={os.getenv('POSTGRES_PASSWORD', 'postgres')}")
+
+
+def zipf_cum_weights(n, exponent):
+    """Cumulative Zipf weights so a few products sell far more than the long tail"""
+    cum_weights = []
+    total = 0.0
+    for rank in range(1, n + 1):
+        total += 1.0 / rank ** exponent
+        cum_weights.append(total)
+    return cum_weights
+
+
+def copy_rows(cur, table, columns, buffer):
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+# Products
+PRODUCT_COLUMNS = ['slug', 'name', 'price', 'description', 'image_url', 'origin_country', 'brand',
+                   'material', 'category', 'rating', 'in_stock', 'release_date', 'warranty_months',
+                   'weight_grams']
+
+def generate_products(rng, count, first_number=1):
+    """Returns [(slug, category, price)] in id order; rows are written by load_products.
+
+    Slugs are numbered from first_number, so loading into a non-empty table doesn't
+    collide with products from an earlier run.
+    """
+    categories = list(CATEGORIES)
+    products = []
+    rows = []
+    for n, i in enumerate(range(first_number, first_number + count), 1):
+        category = categories[n % len(categories)] if n <= len(categories) else rng.choice(categories)
+        median_price, materials, weight, warranty = CATEGORIES[category]
+        brand = rng.choice(BRANDS)
+        adjective = rng.choice(ADJECTIVES)
+        slug = f"{brand.lower().replace(' & ', '-').replace(' ', '-')}-{category.lower()}-{i:07d}"
+        price = max(100, int(rng.lognormvariate(math.log(median_price), 0.45)) // 50 * 50 - 1)
+        release = date(2018, 1, 1) + timedelta(days=rng.randrange(2900))
+        rows.append('\t'.join(map(str, [
+            slug,
+            f"{brand} {adjective} {category} {i}",
+            price,
+            f"{adjective} {category.lower()} by {brand}.",
+            f"https://images.example.com/products/{slug}.jpg",
+            rng.choice(COUNTRIES),
+            brand,
+            rng.choice(materials),
+            category,
+            f"{min(5.0, max(1.0, rng.gauss(4.3, 0.5))):.2f}",
+            't' if rng.random() < 0.95 else 'f',
+            release.isoformat(),
+            warranty,
+            max(1, int(rng.gauss(weight, weight * 0.2)))
+        ])))
+        products.append((slug, category, price))
+    return products, rows
+
+
+def load_products(cur, rows, chunk_size):
+    for start in range(0, len(rows), chunk_size):
+        copy_rows(cur, 'products', PRODUCT_COLUMNS, io.StringIO('\n'.join(rows[start:start + chunk_size]) + '\n'))
+
+
+# Transactions and line items
+TRANSACTION_COLUMNS = ['id', 'customer_name', 'customer_email', 'total_price', 'status', 'address',
+                       'city', 'state', 'zip', 'country', 'created_at', 'updated_at']
+ITEM_COLUMNS = ['transaction_id', 'product_slug', 'quantity', 'price_at_purchase']
+
+def load_transactions(cur, rng, products, count, first_id, end_date, days, chunk_size, zipf_exponent):
+    # Popularity rank is shuffled so it isn't correlated with product id/category
+    ranked = list(range(len(products)))
+    rng.shuffle(ranked)
+    popularity = zipf_cum_weights(len(products), zipf_exponent)
+
+    by_category = {}
+    for rank, index in enumerate(ranked):
+        by_category.setdefault(products[index][1], []).append(index)
+    category_cum_weights = {
+        category: zipf_cum_weights(len(indexes), zipf_exponent) for category, indexes in by_category.items()
+    }
+
+    customers = [(f"{first} {last}", f"{first.lower()}.{last.lower()}{n}@example.com")
+                 for n in range(50) for first in FIRST_NAMES for last in LAST_NAMES]
+    start_time = datetime.combine(end_date, datetime.min.time()) - timedelta(days=days)
+    seconds_per_order = days * 86400 / max(count, 1)
+    item_counts = range(1, len(ITEMS_PER_ORDER_WEIGHTS) + 1)
+    quantities = range(1, len(QUANTITY_WEIGHTS) + 1)
+
+    loaded_items = 0
+    started = time.monotonic()
+    for chunk_start in range(0, count, chunk_size):
+        chunk = min(chunk_size, count - chunk_start)
+        transactions = io.StringIO()
+        items = io.StringIO()
+
+        basket_sizes = rng.choices(item_counts, weights=ITEMS_PER_ORDER_WEIGHTS, k=chunk)
+        first_picks = rng.choices(ranked, cum_weights=popularity, k=chunk)
+        statuses = rng.choices(STATUSES, weights=STATUS_WEIGHTS, k=chunk)
+        line_quantities = iter(rng.choices(quantities, weights=QUANTITY_WEIGHTS, k=chunk * len(item_counts)))
+
+        for n in range(chunk):
+            transaction_id = first_id + chunk_start + n
+            basket = {first_picks[n]}
+            category = products[first_picks[n]][1]
+            attempts = 0
+            while len(basket) < basket_sizes[n] and attempts < 20:
+                attempts += 1
+                if rng.random() < SAME_CATEGORY_PROBABILITY:
+                    basket.add(rng.choices(by_category[category], cum_weights=category_cum_weights[category])[0])
+                else:
+                    basket.add(rng.choices(ranked, cum_weights=popularity)[0])
+
+            total = 0
+            for index in basket:
+                slug, _, price = products[index]
+                quantity = next(line_quantities)
+                total += price * quantity
+                items.write(f"{transaction_id}\t{slug}\t{quantity}\t{price}\n")
+            loaded_items += len(basket)
+
+            name, email = rng.choice(customers)
+            city, state, zip_code, country = rng.choice(CITIES)
+            created = start_time + timedelta(seconds=int((chunk_start + n) * seconds_per_order
+                                                         + rng.random() * seconds_per_order))
+            transactions.write(
+                f"{transaction_id}\t{name}\t{email}\t{total}\t{statuses[n]}\t"
+                f"{rng.randrange(1, 9999)} {rng.choice(STREETS)}\t{city}\t{state}\t{zip_code}\t{country}\t"
+                f"{created}\t{created}\n"
+            )
+
+        copy_rows(cur, 'transactions', TRANSACTION_COLUMNS, transactions)
+        copy_rows(cur, 'transaction_items', ITEM_COLUMNS, items)
+
+        done = chunk_start + chunk
+        rate = done / max(time.monotonic() - started, 0.001)
+        print(f"   transactions: {done:,}/{count:,} ({loaded_items:,} line items, {rate:,.0f} orders/s)",
+              flush=True)
+    return loaded_items
+
+
+def drop_order_table_constraints(cur):
+    for name in ORDER_TABLE_FOREIGN_KEYS:
+        cur.execute(f"ALTER TABLE transaction_items DROP CONSTRAINT IF EXISTS {name}")
+    for name in ORDER_TABLE_INDEXES:
+        cur.execute(f"DROP INDEX IF EXISTS {name}")
+
+def restore_order_table_constraints(cur):
+    for definition in ORDER_TABLE_INDEXES.values():
+        cur.execute(definition)
+    for name, definition in ORDER_TABLE_FOREIGN_KEYS.items():
+        cur.execute(f"ALTER TABLE transaction_items ADD CONSTRAINT {name} {definition}")
+
+
+def reset_sequences(cur):
+    for table in ('products', 'transactions', 'transaction_items'):
+        cur.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                    f"COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-load a synthetic catalog and order history with COPY")
+    parser.add_argument('--products', type=int, default=100000, help="Products to generate")
+    parser.add_argument('--transactions', type=int, default=1000000, help="Transactions to generate")
+    parser.add_argument('--days', type=int, default=365, help="Spread orders over this many days before --end-date")
+    parser.add_argument('--end-date', type=date.fromisoformat, default=date.today(),
+                        help="Last order date, YYYY-MM-DD (default: today; fix it for byte-identical reruns)")
+    parser.add_argument('--seed', type=int, default=42, help="Random seed (same seed + empty tables = same data)")
+    parser.add_argument('--zipf', type=float, default=1.1, help="Product popularity skew")
+    parser.add_argument('--chunk-size', type=int, default=50000, help="Rows per COPY batch")
+    parser.add_argument('--truncate', action='store_true',
+                        help="Empty products, transactions and transaction_items first")
+    parser.add_argument('--dsn', help="libpq connection string (default: DATABASE_URL or POSTGRES_* env)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.products < 1:
+        print("--products must be at least 1")
+        return 1
+
+    rng = random.Random(args.seed)
+    started = time.monotonic()
+
+    conn = psycopg2.connect(get_dsn(args))
+    try:
+        with conn.cursor() as cur:
+            if args.truncate:
+                print("🧹 Truncating products, transactions and transaction_items")
+                cur.execute("TRUNCATE transaction_items, transactions, products RESTART IDENTITY")
+
+            cur.execute("SELECT COALESCE(MAX(id), 0) FROM transactions")
+            first_id = cur.fetchone()[0] + 1
+            # Without --truncate, continue numbering after the products already there
+            cur.execute("SELECT COUNT(*) FROM products")
+            first_product = cur.fetchone()[0] + 1
+
+            print(f"📦 Generating {args.products:,} products (seed {args.seed})")
+            products, product_rows = generate_products(rng, args.products, first_product)
+            load_products(cur, product_rows, args.chunk_size)
+            del product_rows
+
+            print(f"🧾 Generating {args.transactions:,} transactions")
+            drop_order_table_constraints(cur)
+            loaded_items = load_transactions(cur, rng, products, args.transactions, first_id,
+                                             args.end_date, args.days, args.chunk_size, args.zipf)
+
+            print("🔧 Rebuilding indexes and foreign keys")
+            restore_order_table_constraints(cur)
+            reset_sequences(cur)
+
+        conn.commit()
+    except psycopg2.errors.UniqueViolation as e:
+        # e.g. products deleted since an earlier run, so the numbering overlaps it
+        conn.rollback()
+        print(f"❌ Generated rows collide with existing data ({e.diag.constraint_name}); "
+              f"re-run with --truncate")
+        return 1
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    # ANALYZE outside the load transaction so the planner sees the new volumes
+    conn = psycopg2.connect(get_dsn(args))
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("ANALYZE products, transactions, transaction_items")
+    finally:
+        conn.close()
+
+    print(f"✅ Loaded {args.products:,} products, {args.transactions:,} transactions and "
+          f"{loaded_items:,} line items in {time.monotonic() - started:.0f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,27 +1,96 @@
 # Gunicorn configuration file
+import math
 import multiprocessing
 import os
+import threading
 
 # Server socket
 bind = "0.0.0.0:8080"
 backlog = 2048
 
-# Worker processes - adjusted for ECS Fargate resources
-# With 512 CPU units (0.5 vCPU), use 2 workers max
-workers = 2
-worker_class = "sync"
-worker_connections = 1000
+
+# Container resource detection (cgroup v2, then v1, then the host)
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+def detect_cpu_limit():
+    """CPUs available to the container, e.g. 0.5 for a 512 CPU unit Fargate task"""
+    cpu_max = _read_first_line("/sys/fs/cgroup/cpu.max")  # v2: "<quota> <period>" or "max <period>"
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max" and period:
+            return int(quota) / int(period), "cgroup v2 cpu.max"
+
+    quota = _read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")  # v1
+    period = _read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period), "cgroup v1 cfs quota"
+
+    return float(multiprocessing.cpu_count()), "host cpu count"
+
+def detect_memory_limit_mb():
+    """Memory limit of the container in MB"""
+    for path in ("/sys/fs/cgroup/memory.max",                     # v2
+                 "/sys/fs/cgroup/memory/memory.limit_in_bytes"):  # v1
+        value = _read_first_line(path)
+        # v1 reports a huge sentinel (~2^63) when unlimited
+        if value and value != "max" and int(value) < 2 ** 60:
+            return int(value) // (1024 * 1024), path
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) // 1024, "/proc/meminfo"
+    except OSError:
+        pass
+    return 512, "default"
+
+
+CPU_LIMIT, CPU_SOURCE = detect_cpu_limit()
+MEMORY_LIMIT_MB, MEMORY_SOURCE = detect_memory_limit_mb()
+
+# Memory budget per worker and headroom for the master / sidecars
+WORKER_MEMORY_MB = int(os.getenv("WORKER_MEMORY_MB", 150))
+MEMORY_RESERVE_MB = int(os.getenv("MEMORY_RESERVE_MB", 100))
+
+# Worker processes - derived from the task's CPU quota and memory limit
+# Requests mostly wait on Postgres, Redis and Stripe, so threads cover the I/O wait
+# and processes are scaled to the CPUs actually granted to the container
+cpu_workers = max(1, math.ceil(CPU_LIMIT * 2))
+memory_workers = max(1, (MEMORY_LIMIT_MB - MEMORY_RESERVE_MB) // WORKER_MEMORY_MB)
+workers = int(os.getenv("GUNICORN_WORKERS", min(cpu_workers, memory_workers)))
+threads = int(os.getenv("GUNICORN_THREADS", 4 if CPU_LIMIT < 2 else 2))
+worker_class = "gthread" if threads > 1 else "sync"
+worker_connections = 1000  # gthread: max queued keep-alive connections per worker
+
+# Database pool per worker: one connection per request thread, plus one so a nested
+# borrow can't starve (read by checkout_service, which preload_app imports after this)
+os.environ.setdefault("DB_POOL_MAX", str(threads + 1))
 
 # Timeouts - CRITICAL for fixing worker timeouts
 timeout = 120  # Worker timeout (was causing your CRITICAL WORKER TIMEOUT errors)
 keepalive = 5
 graceful_timeout = 30
 
+# Checkout idempotency locks must outlive a request the worker is still allowed to run
+os.environ.setdefault("IDEMPOTENCY_LOCK_SECONDS", str(timeout + 30))
+
 # Memory management
 max_requests = 1000
 max_requests_jitter = 100
 preload_app = True
 
+# Memory watchdog - gracefully recycle a worker once its memory passes the threshold.
+# Measured as PSS, so copy-on-write pages shared with the preloaded master are split
+# between the processes sharing them instead of being counted in full by every worker
+MAX_WORKER_RSS_MB = int(os.getenv("MAX_WORKER_RSS_MB", WORKER_MEMORY_MB + WORKER_MEMORY_MB // 3))
+RSS_CHECK_INTERVAL = int(os.getenv("RSS_CHECK_INTERVAL", 10))  # Check every N requests
+
 # Logging
 loglevel = "info"
 accesslog = "-"  # Log to stdout
@@ -39,5 +108,67 @@ group = None
 tmp_upload_dir = None
 
 # Worker lifecycle
-max_worker_memory = 200  # MB - restart worker if it uses more memory
-worker_tmp_dir = "/dev/shm"  # Use shared memory for better performance
\ No newline at end of file
+worker_tmp_dir = "/dev/shm"  # Use shared memory for better performance
+
+
+def current_pss_mb():
+    """Proportional set size of this process in MB (resident size on kernels without smaps_rollup)"""
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+# Server hooks
+def when_ready(server):
+    """Startup report of the detected resources and chosen settings"""
+    server.log.info(
+        "Auto-tuned settings: cpu_limit=%.2f (%s), memory_limit=%dMB (%s) -> "
+        "workers=%d, threads=%d, worker_class=%s, max_worker_rss=%dMB, db_pool_max=%s",
+        CPU_LIMIT, CPU_SOURCE, MEMORY_LIMIT_MB, MEMORY_SOURCE,
+        workers, threads, worker_class, MAX_WORKER_RSS_MB, os.environ["DB_POOL_MAX"]
+    )
+    if workers * MAX_WORKER_RSS_MB + MEMORY_RESERVE_MB > MEMORY_LIMIT_MB:
+        server.log.warning(
+            "workers x MAX_WORKER_RSS_MB exceeds the container memory limit; "
+            "the OOM killer may act before the memory watchdog"
+        )
+
+def post_fork(server, worker):
+    worker.requests_since_rss_check = 0
+    worker.rss_check_lock = threading.Lock()  # post_request runs on the gthread request threads
+
+def post_worker_init(worker):
+    # Installed after gunicorn resets the worker's signal handlers;
+    # `kill -PROF <worker pid>` toggles/reports tracemalloc for that worker only
+    from profiling import profiler
+    profiler.install_signal_handler()
+
+    # Build the co-purchase index in the background, off the request path
+    from checkout_service import start_recommendation_refresher
+    start_recommendation_refresher()
+
+def post_request(worker, req, environ, resp):
+    with worker.rss_check_lock:
+        worker.requests_since_rss_check += 1
+        if worker.requests_since_rss_check < RSS_CHECK_INTERVAL:
+            return
+        worker.requests_since_rss_check = 0
+
+    pss_mb = current_pss_mb()
+    if pss_mb > MAX_WORKER_RSS_MB and worker.alive:
+        worker.log.warning(
+            "Worker %s memory (PSS) %.0fMB exceeds %dMB, recycling gracefully",
+            worker.pid, pss_mb, MAX_WORKER_RSS_MB
+        )
+        worker.alive = False  # Finishes in-flight requests, then the arbiter replaces it
@@ -58,6 +58,16 @@ CREATE TABLE IF NOT EXISTS transaction_items (
     FOREIGN KEY (product_slug) REFERENCES products(slug)
 );
 
+-- Checkout idempotency keys (used when Redis is not configured)
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key VARCHAR(64) PRIMARY KEY,                 -- sha256 of session + client key + payment token
+    state VARCHAR(20) NOT NULL CHECK (state IN ('in_flight', 'done')),
+    fingerprint VARCHAR(64),                     -- sha256 of the cart at submission
+    response JSONB,                              -- Stored outcome replayed to retries
+    expires_at TIMESTAMP NOT NULL,               -- Lock expiry while in flight, replay window once done
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
 -- ======================
 -- 2. INDEXES
 -- ======================
@@ -68,6 +78,7 @@ CREATE INDEX IF NOT EXISTS idx_transactions_status ON transactions(status);
 CREATE INDEX IF NOT EXISTS idx_transactions_email ON transactions(customer_email);
 CREATE INDEX IF NOT EXISTS idx_transactions_stripe ON transactions(stripe_charge_id);
 CREATE INDEX IF NOT EXISTS idx_items_transaction ON transaction_items(transaction_id);
+CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency_keys(expires_at);
 
 -- ======================
 -- 3. SAMPLE DATA
@@ -111,6 +122,7 @@ GRANT CONNECT ON DATABASE checkoutdb TO checkout_app;
 GRANT USAGE ON SCHEMA public TO checkout_app;
 GRANT SELECT ON products TO checkout_app;
 GRANT SELECT, INSERT ON transactions, transaction_items TO checkout_app;
+GRANT SELECT, INSERT, UPDATE, DELETE ON idempotency_keys TO checkout_app;
 */
 
 COMMIT;
@@ -121,4 +133,6 @@ COMMIT;
 
 -- Recommended to run after initial setup:
 -- CREATE EXTENSION IF NOT EXISTS pg_stat_statements;
--- CREATE EXTENSION IF NOT EXISTS pgcrypto;
\ No newline at end of file
+-- CREATE EXTENSION IF NOT EXISTS pgcrypto;
+-- Purge expired idempotency keys periodically:
+-- DELETE FROM idempotency_keys WHERE expires_at < NOW();
\ No newline at end of file
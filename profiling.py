@@ -0,0 +1,292 @@
+# profiling.py - Opt-in allocation / memory profiling for the gunicorn workers
+import os
+import hmac
+import signal
+import logging
+import threading
+import tracemalloc
+from collections import OrderedDict
+from flask import jsonify, make_response, request, g, abort
+
+logger = logging.getLogger(__name__)
+
+# Profiling configuration
+MEMORY_PROFILING_ENABLED = os.getenv('MEMORY_PROFILING_ENABLED', 'false').lower() == 'true'
+TRACEMALLOC_FRAMES = int(os.getenv('TRACEMALLOC_FRAMES', 10))
+MEMORY_LOG_PEAKS = os.getenv('MEMORY_LOG_PEAKS', 'true').lower() == 'true'
+MAX_SNAPSHOTS = int(os.getenv('MEMORY_MAX_SNAPSHOTS', 5))
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')  # Admin endpoints are disabled unless this is set
+
+# Signal sent to a single worker pid (kill -PROF <pid>): first starts tracing,
+# each later one logs the diff against the previous signal's snapshot
+PROFILE_SIGNAL = signal.SIGPROF
+
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+def format_stats(stats, limit):
+    """JSON-friendly view of tracemalloc Statistic / StatisticDiff entries"""
+    rows = []
+    for stat in stats[:limit]:
+        frame = stat.traceback[0]
+        row = {
+            'location': f"{frame.filename}:{frame.lineno}",
+            'size_kb': round(stat.size / 1024, 1),
+            'count': stat.count
+        }
+        if hasattr(stat, 'size_diff'):
+            row['size_diff_kb'] = round(stat.size_diff / 1024, 1)
+            row['count_diff'] = stat.count_diff
+        rows.append(row)
+    return rows
+
+
+class MemoryProfiler:
+    """tracemalloc snapshots, per-route allocation sampling and per-request peaks"""
+
+    def __init__(self):
+        self.snapshots = OrderedDict()
+        self.route_samples_left = 0
+        self.route_stats = {}
+        self.in_flight = 0
+        self.requests_started = 0
+        self._signal_snapshot = None
+        self._signal_event = threading.Event()
+        self._signal_thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Register request hooks and the protected admin endpoints"""
+        if MEMORY_PROFILING_ENABLED and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            logger.info(f"tracemalloc started ({TRACEMALLOC_FRAMES} frames)")
+
+        app.before_request(self._start_request)
+        app.teardown_request(self._finish_request)
+
+        endpoints = [
+            ('/admin/memory/start', 'start', self.start_view, ['POST']),
+            ('/admin/memory/stop', 'stop', self.stop_view, ['POST']),
+            ('/admin/memory/snapshot', 'snapshot', self.snapshot_view, ['POST']),
+            ('/admin/memory/diff', 'diff', self.diff_view, ['GET']),
+            ('/admin/memory/sample-routes', 'sample_routes', self.sample_routes_view, ['POST']),
+            ('/admin/memory/routes', 'routes', self.routes_view, ['GET']),
+        ]
+        for rule, name, view, methods in endpoints:
+            app.add_url_rule(rule, f'memory_{name}', self._protected(view), methods=methods)
+
+    # Admin endpoint protection
+    @staticmethod
+    def _protected(view):
+        def wrapper():
+            # Unknown unless enabled, so the endpoints can't be discovered
+            if not ADMIN_TOKEN:
+                abort(404)
+            token = request.headers.get('X-Admin-Token', '')
+            if not hmac.compare_digest(token, ADMIN_TOKEN):
+                return jsonify({'error': 'Forbidden'}), 403
+            response = make_response(view())
+            response.headers['X-Worker-Pid'] = str(os.getpid())
+            return response
+        return wrapper
+
+    # Snapshots and diffs
+    def save_snapshot(self, name):
+        snapshot = take_snapshot()
+        with self._lock:
+            self.snapshots.pop(name, None)
+            self.snapshots[name] = snapshot
+            while len(self.snapshots) > MAX_SNAPSHOTS:
+                self.snapshots.popitem(last=False)
+        return snapshot
+
+    def diff(self, old, new, limit=20, key_type='lineno'):
+        return format_stats(new.compare_to(old, key_type), limit)
+
+    # Per-route sampling over the next N requests
+    def sample_routes(self, requests):
+        with self._lock:
+            self.route_samples_left = requests
+            self.route_stats = {}
+
+    def _start_request(self):
+        if not tracemalloc.is_tracing():
+            return
+        # tracemalloc's peak and snapshots are process-wide, so only a request that runs
+        # alone (none in flight when it starts, none started before it finishes) is measured
+        with self._lock:
+            self.in_flight += 1
+            self.requests_started += 1
+            g._memory_tracked = True
+            if self.in_flight > 1:
+                return
+            g._memory_started = self.requests_started
+            sampled = self.route_samples_left > 0
+            if sampled:
+                self.route_samples_left -= 1
+                g._memory_snapshot = take_snapshot()
+            # After the snapshot, so the profiler's own snapshot isn't counted as the request's
+            if MEMORY_LOG_PEAKS:
+                tracemalloc.reset_peak()
+                g._memory_start = tracemalloc.get_traced_memory()[0]
+
+    def _finish_request(self, error=None):
+        if not g.pop('_memory_tracked', False):
+            return
+        start = g.pop('_memory_start', None)
+        before = g.pop('_memory_snapshot', None)
+        with self._lock:
+            self.in_flight -= 1
+            alone = g.pop('_memory_started', None) == self.requests_started and tracemalloc.is_tracing()
+            if alone:
+                # Measured before another request can start
+                current, peak = tracemalloc.get_traced_memory()
+                after = take_snapshot() if before is not None else None
+            elif before is not None:
+                self.route_samples_left += 1  # Overlapped, so give the sample back
+        if not alone:
+            return
+        route = str(request.url_rule) if request.url_rule else request.path
+
+        if start is not None:
+            logger.info(f"Memory {request.method} {route}: peak +{(peak - start) / 1024:.1f} KiB, "
+                        f"retained {(current - start) / 1024:+.1f} KiB")
+
+        if before is None:
+            return
+        stats = after.compare_to(before, 'lineno')
+        with self._lock:
+            route_stats = self.route_stats.setdefault(route, {'requests': 0, 'allocators': {}})
+            route_stats['requests'] += 1
+            for stat in stats:
+                if stat.size_diff <= 0:
+                    continue
+                frame = stat.traceback[0]
+                location = f"{frame.filename}:{frame.lineno}"
+                route_stats['allocators'][location] = route_stats['allocators'].get(location, 0) + stat.size_diff
+
+    def top_route_allocators(self, limit=10):
+        with self._lock:
+            return {
+                route: {
+                    'requests': stats['requests'],
+                    'top_allocators': [
+                        {'location': location, 'size_kb': round(size / 1024, 1)}
+                        for location, size in sorted(stats['allocators'].items(),
+                                                     key=lambda item: item[1], reverse=True)[:limit]
+                    ]
+                }
+                for route, stats in self.route_stats.items()
+            }
+
+    # Signal trigger (installed per worker from gunicorn's post_worker_init)
+    def install_signal_handler(self):
+        # The handler runs on the worker's main thread (the gthread event loop), so it only
+        # wakes a helper thread; snapshots and logging happen there without stalling I/O
+        self._signal_thread = threading.Thread(target=self._signal_loop, name='memory-profiler', daemon=True)
+        self._signal_thread.start()
+        signal.signal(PROFILE_SIGNAL, self._handle_signal)
+
+    def _handle_signal(self, signum, frame):
+        self._signal_event.set()
+
+    def _signal_loop(self):
+        while True:
+            self._signal_event.wait()
+            self._signal_event.clear()
+            try:
+                self._report_signal()
+            except Exception as e:
+                logger.warning(f"Worker {os.getpid()}: memory report failed: {e}")
+
+    def _report_signal(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            logger.warning(f"Worker {os.getpid()}: tracemalloc started by signal")
+            return
+
+        snapshot = take_snapshot()
+        if self._signal_snapshot is None:
+            rows = format_stats(snapshot.statistics('lineno'), 20)
+            logger.warning(f"Worker {os.getpid()}: top allocations")
+        else:
+            rows = self.diff(self._signal_snapshot, snapshot)
+            logger.warning(f"Worker {os.getpid()}: allocation growth since previous signal")
+        self._signal_snapshot = snapshot
+        for row in rows:
+            logger.warning(f"  {row}")
+
+    # Admin views
+    def start_view(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(int(request.args.get('frames', TRACEMALLOC_FRAMES)))
+        return jsonify({'status': 'tracing', 'pid': os.getpid()})
+
+    def stop_view(self):
+        tracemalloc.stop()
+        with self._lock:
+            self.snapshots.clear()
+            self.route_samples_left = 0
+        return jsonify({'status': 'stopped', 'pid': os.getpid()})
+
+    def snapshot_view(self):
+        if not tracemalloc.is_tracing():
+            return jsonify({'error': 'tracemalloc is not running'}), 409
+        name = request.args.get('name', 'default')
+        snapshot = self.save_snapshot(name)
+        limit = int(request.args.get('limit', 20))
+        return jsonify({
+            'pid': os.getpid(),
+            'name': name,
+            'traced_kb': round(tracemalloc.get_traced_memory()[0] / 1024, 1),
+            'top': format_stats(snapshot.statistics('lineno'), limit)
+        })
+
+    def diff_view(self):
+        if not tracemalloc.is_tracing():
+            return jsonify({'error': 'tracemalloc is not running'}), 409
+        old_name = request.args.get('from', 'default')
+        new_name = request.args.get('to')
+        with self._lock:
+            old = self.snapshots.get(old_name)
+            new = self.snapshots.get(new_name) if new_name else None
+        if old is None or (new_name and new is None):
+            return jsonify({'error': 'Unknown snapshot', 'available': list(self.snapshots)}), 404
+        if new is None:
+            new = take_snapshot()
+
+        limit = int(request.args.get('limit', 20))
+        key_type = request.args.get('group_by', 'lineno')
+        if key_type not in ('lineno', 'filename', 'traceback'):
+            return jsonify({'error': 'group_by must be lineno, filename or traceback'}), 400
+        return jsonify({
+            'pid': os.getpid(),
+            'from': old_name,
+            'to': new_name or 'now',
+            'diff': self.diff(old, new, limit, key_type)
+        })
+
+    def sample_routes_view(self):
+        if not tracemalloc.is_tracing():
+            return jsonify({'error': 'tracemalloc is not running'}), 409
+        requests = int(request.args.get('requests', 100))
+        self.sample_routes(requests)
+        return jsonify({'pid': os.getpid(), 'sampling_requests': requests})
+
+    def routes_view(self):
+        return jsonify({
+            'pid': os.getpid(),
+            'samples_left': self.route_samples_left,
+            'routes': self.top_route_allocators(int(request.args.get('limit', 10)))
+        })
+
+
+profiler = MemoryProfiler()
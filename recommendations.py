@@ -0,0 +1,299 @@
+# recommendations.py - "Frequently bought together" co-purchase index
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from itertools import permutations
+
+logger = logging.getLogger(__name__)
+
+# Recommendation configuration
+RECOMMENDATION_TOP_K = int(os.getenv('RECOMMENDATION_TOP_K', 4))          # Served per item
+RECOMMENDATION_KEEP = int(os.getenv('RECOMMENDATION_KEEP', 50))           # Stored per item (2x between rebuilds)
+RECOMMENDATION_REBUILD_SECONDS = int(os.getenv('RECOMMENDATION_REBUILD_SECONDS', 3600))
+RECOMMENDATION_CHECK_SECONDS = int(os.getenv('RECOMMENDATION_CHECK_SECONDS', 60))   # Background staleness check
+RECOMMENDATION_BUILD_LOCK_SECONDS = int(os.getenv('RECOMMENDATION_BUILD_LOCK_SECONDS', 1800))
+
+REDIS_PREFIX = 'copurchase'
+
+# Pair counts for completed orders, already cut down to the top N related items per item
+BUILD_PAIRS_SQL = '''
+    WITH pairs AS (
+        SELECT a.product_slug AS item, b.product_slug AS related, COUNT(*) AS together
+        FROM transaction_items a
+        JOIN transaction_items b
+          ON b.transaction_id = a.transaction_id AND b.product_slug <> a.product_slug
+        JOIN transactions t ON t.id = a.transaction_id AND t.status = 'completed'
+        GROUP BY a.product_slug, b.product_slug
+    ), ranked AS (
+        SELECT item, related, together,
+               ROW_NUMBER() OVER (PARTITION BY item ORDER BY together DESC, related) AS rank
+        FROM pairs
+    )
+    SELECT item, related, together FROM ranked WHERE rank <= %s
+'''
+
+BUILD_ORDERS_SQL = '''
+    SELECT ti.product_slug AS item, COUNT(DISTINCT ti.transaction_id) AS orders
+    FROM transaction_items ti
+    JOIN transactions t ON t.id = ti.transaction_id AND t.status = 'completed'
+    GROUP BY ti.product_slug
+'''
+
+
+class CoPurchaseIndex:
+    """item -> top related items, stored in Redis sorted sets or an in-process dict
+
+    Scores are confidence values: the share of orders containing the item that
+    also contained the related item.
+    """
+
+    def __init__(self, redis_client=None, keep=RECOMMENDATION_KEEP):
+        self.redis = redis_client
+        self.keep = keep
+        # Incremental updates trim to this; only rebuilds cut back to `keep`, so new
+        # pairs (score 1) aren't evicted the moment they arrive on a full item
+        self.slack = 2 * keep
+        self.pairs = {}        # in-memory: item -> {related: together}
+        self.item_orders = {}  # in-memory: item -> orders containing it
+        self.built_at = None
+        self._building = False
+        self._pending = []     # in-memory: orders recorded while a rebuild runs
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._refresher = None
+        self._refresher_pid = None
+
+    # Bulk build
+    def read_history(self, conn):
+        """Aggregate the order history into (pairs, item_orders)"""
+        pairs = {}
+        with conn.cursor() as cur:
+            cur.execute(BUILD_PAIRS_SQL, (self.keep,))
+            for row in cur.fetchall():
+                pairs.setdefault(row['item'], {})[row['related']] = row['together']
+
+            cur.execute(BUILD_ORDERS_SQL)
+            item_orders = {row['item']: row['orders'] for row in cur.fetchall()}
+        return pairs, item_orders
+
+    def rebuild(self, conn):
+        """Replace the index with one built from the full order history.
+
+        Orders recorded while the history is being read are logged and replayed
+        onto the new index once it is swapped in.
+        """
+        started = time.monotonic()
+        if self.redis:
+            self.redis.delete(f"{REDIS_PREFIX}:pending")
+        else:
+            with self._lock:
+                self._building = True
+                self._pending = []
+
+        try:
+            pairs, item_orders = self.read_history(conn)
+        except Exception:
+            with self._lock:
+                self._building = False
+            raise
+
+        if self.redis:
+            self._store_redis(pairs, item_orders)
+        else:
+            with self._lock:
+                self.pairs = pairs
+                self.item_orders = item_orders
+                self._building = False
+                pending, self._pending = self._pending, []
+                for items in pending:
+                    self._record_memory(items)
+        self.built_at = time.time()
+
+        logger.info(f"Co-purchase index built: {len(pairs)} items in {time.monotonic() - started:.1f}s")
+
+    def _store_redis(self, pairs, item_orders):
+        """Write the new index under temporary keys, then RENAME it into place in one transaction"""
+        items_key = f"{REDIS_PREFIX}:items"
+        tmp = f"{REDIS_PREFIX}:tmp:{uuid.uuid4().hex}"
+        stale = set(self.redis.smembers(items_key)) - set(pairs)
+
+        # Temporary keys expire in case the build dies before the swap
+        pipe = self.redis.pipeline(transaction=False)
+        for i, (item, related) in enumerate(pairs.items(), 1):
+            pipe.zadd(f"{tmp}:{item}", related)
+            pipe.expire(f"{tmp}:{item}", RECOMMENDATION_BUILD_LOCK_SECONDS)
+            if i % 1000 == 0:
+                pipe.execute()
+        if pairs:
+            pipe.sadd(f"{tmp}:items", *pairs)
+            pipe.expire(f"{tmp}:items", RECOMMENDATION_BUILD_LOCK_SECONDS)
+        if item_orders:
+            pipe.hset(f"{tmp}:orders", mapping=item_orders)
+            pipe.expire(f"{tmp}:orders", RECOMMENDATION_BUILD_LOCK_SECONDS)
+        pipe.execute()
+
+        # Readers see either the old index or the new one, never a partial one
+        pipe = self.redis.pipeline(transaction=True)
+        for item in stale:
+            pipe.delete(f"{REDIS_PREFIX}:{item}")
+        renames = list(pairs)
+        renames += ['items'] if pairs else []
+        renames += ['orders'] if item_orders else []
+        pipe.delete(items_key, f"{REDIS_PREFIX}:orders")
+        for name in renames:
+            pipe.rename(f"{tmp}:{name}", f"{REDIS_PREFIX}:{name}")
+            pipe.persist(f"{REDIS_PREFIX}:{name}")
+        # Expires when the index is due for a rebuild (see is_stale)
+        pipe.set(f"{REDIS_PREFIX}:built_at", time.time(), ex=RECOMMENDATION_REBUILD_SECONDS)
+        pipe.lrange(f"{REDIS_PREFIX}:pending", 0, -1)
+        pipe.delete(f"{REDIS_PREFIX}:pending")
+        pending = pipe.execute()[-2]
+
+        if pending:
+            pipe = self.redis.pipeline(transaction=False)
+            for raw in pending:
+                self._record_redis(pipe, json.loads(raw))
+            pipe.execute()
+
+    def ensure_built(self, connect, force=False):
+        """Build the index if missing/expired (or forced); only one worker/thread builds at a time.
+
+        Returns True if this call built it.
+        """
+        if not force and not self.is_stale():
+            return False
+        if self.redis:
+            if not self.redis.set(f"{REDIS_PREFIX}:building", os.getpid(), nx=True,
+                                  ex=RECOMMENDATION_BUILD_LOCK_SECONDS):
+                return False
+        elif not self._build_lock.acquire(blocking=False):
+            return False
+
+        try:
+            with connect() as conn:
+                self.rebuild(conn)
+            return True
+        finally:
+            if self.redis:
+                self.redis.delete(f"{REDIS_PREFIX}:building")
+            else:
+                self._build_lock.release()
+
+    def start_refresher(self, connect):
+        """Keep the index built from a background thread, so requests only ever read it"""
+        # Threads don't survive gunicorn's fork, so start one per worker process
+        if self._refresher_pid == os.getpid() and self._refresher.is_alive():
+            return
+        self._refresher_pid = os.getpid()
+        self._refresher = threading.Thread(target=self._refresh_loop, args=(connect,),
+                                           name='copurchase-refresh', daemon=True)
+        self._refresher.start()
+
+    def _refresh_loop(self, connect):
+        while True:
+            try:
+                self.ensure_built(connect)
+            except Exception as e:
+                logger.warning(f"Co-purchase index build failed, retrying: {e}")
+            time.sleep(RECOMMENDATION_CHECK_SECONDS)
+
+    def is_stale(self):
+        if self.redis:
+            return not self.redis.exists(f"{REDIS_PREFIX}:built_at")
+        return self.built_at is None or time.time() - self.built_at > RECOMMENDATION_REBUILD_SECONDS
+
+    # Incremental updates
+    def record_order(self, items):
+        """Add one completed order's items to the index"""
+        items = list(dict.fromkeys(items))
+        if not items:
+            return
+
+        if self.redis:
+            pipe = self.redis.pipeline(transaction=False)
+            self._record_redis(pipe, items)
+            if self.redis.exists(f"{REDIS_PREFIX}:building"):
+                # Replayed onto the new index when the running rebuild swaps it in
+                pipe.rpush(f"{REDIS_PREFIX}:pending", json.dumps(items))
+                pipe.expire(f"{REDIS_PREFIX}:pending", RECOMMENDATION_BUILD_LOCK_SECONDS)
+            pipe.execute()
+            return
+
+        with self._lock:
+            self._record_memory(items)
+            if self._building:
+                self._pending.append(items)
+
+    def _record_redis(self, pipe, items):
+        for item in items:
+            pipe.hincrby(f"{REDIS_PREFIX}:orders", item, 1)
+        for item, related in permutations(items, 2):
+            pipe.zincrby(f"{REDIS_PREFIX}:{item}", 1, related)
+        for item in items:
+            pipe.sadd(f"{REDIS_PREFIX}:items", item)
+            # Keep only the strongest pairs so the index stays compact
+            pipe.zremrangebyrank(f"{REDIS_PREFIX}:{item}", 0, -(self.slack + 1))
+
+    def _record_memory(self, items):
+        """Caller holds self._lock"""
+        for item in items:
+            self.item_orders[item] = self.item_orders.get(item, 0) + 1
+        for item, related in permutations(items, 2):
+            counts = self.pairs.setdefault(item, {})
+            counts[related] = counts.get(related, 0) + 1
+            if len(counts) > self.slack:
+                # Evict the weakest pair; on a tie, one other than the pair just counted
+                del counts[min(counts, key=lambda slug: (counts[slug], slug == related))]
+
+    # Serving
+    def related(self, items, k=RECOMMENDATION_TOP_K, exclude=()):
+        """Top-k related items for one or more items as [(slug, score)], merged by best score"""
+        items = list(dict.fromkeys(items))
+        exclude = set(exclude) | set(items)
+        scores = {}
+
+        for item, related, orders in self._lookup(items):
+            if not orders:
+                continue
+            for slug, together in related:
+                if slug in exclude:
+                    continue
+                scores[slug] = max(scores.get(slug, 0.0), together / orders)
+
+        ranked = sorted(scores.items(), key=lambda pair: (-pair[1], pair[0]))[:k]
+        return [(slug, round(score, 4)) for slug, score in ranked]
+
+    def _lookup(self, items):
+        if not items:
+            return []
+
+        if self.redis:
+            # One round trip regardless of the number of items
+            pipe = self.redis.pipeline(transaction=False)
+            for item in items:
+                pipe.zrevrange(f"{REDIS_PREFIX}:{item}", 0, self.keep - 1, withscores=True)
+            pipe.hmget(f"{REDIS_PREFIX}:orders", items)
+            *related, orders = pipe.execute()
+            return [(item, related[i], int(orders[i] or 0)) for i, item in enumerate(items)]
+
+        with self._lock:
+            return [
+                (item, list(self.pairs.get(item, {}).items()), self.item_orders.get(item, 0))
+                for item in items
+            ]
+
+
+if __name__ == '__main__':
+    # Usage: python recommendations.py  - rebuild the index from the order history
+    from checkout_service import get_db_connection, redis_client
+
+    if not redis_client:
+        print("REDIS_URL is not configured; each worker builds its in-memory index in the background")
+    else:
+        if CoPurchaseIndex(redis_client).ensure_built(get_db_connection, force=True):
+            print("Co-purchase index rebuilt in Redis")
+        else:
+            print("Another process is already rebuilding the index")
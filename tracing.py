@@ -0,0 +1,356 @@
+# tracing.py - Lightweight per-request tracing for the checkout service
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import random
+import logging
+import threading
+import urllib.request
+from contextlib import contextmanager
+from flask import g, has_request_context, request, before_render_template, template_rendered
+
+logger = logging.getLogger(__name__)
+
+# Tracing configuration
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'false').lower() == 'true'
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0.01))  # Fraction of requests always kept
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', 500))           # Requests slower than this are always kept
+TRACE_EXPORT_FILE = os.getenv('TRACE_EXPORT_FILE')                # JSON lines, one trace per line
+TRACE_COLLECTOR_URL = os.getenv('TRACE_COLLECTOR_URL')            # HTTP endpoint accepting POSTed traces
+
+
+class Span:
+    """A timed operation inside a request trace"""
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start = time.time()
+        self._start_perf = time.perf_counter()
+        self.duration_ms = None
+
+    def finish(self):
+        self.duration_ms = (time.perf_counter() - self._start_perf) * 1000
+
+    def to_dict(self, trace_start):
+        return {
+            'name': self.name,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'offset_ms': round((self.start - trace_start) * 1000, 3),
+            'duration_ms': round(self.duration_ms or 0.0, 3),
+            'attributes': self.attributes,
+            'error': self.error
+        }
+
+
+class Trace:
+    """All spans recorded for one request"""
+
+    def __init__(self, trace_id, parent_span_id=None, sampled=False):
+        self.trace_id = trace_id
+        self.parent_span_id = parent_span_id
+        self.sampled = sampled
+        self.spans = []
+        self.stack = []
+
+    @property
+    def root(self):
+        return self.spans[0] if self.spans else None
+
+    def to_dict(self):
+        root = self.root
+        return {
+            'trace_id': self.trace_id,
+            'parent_span_id': self.parent_span_id,
+            'name': root.name,
+            'timestamp': root.start,
+            'duration_ms': round(root.duration_ms or 0.0, 3),
+            'attributes': root.attributes,
+            'spans': [span.to_dict(root.start) for span in self.spans]
+        }
+
+
+# Exporters
+class SpanExporter:
+    """Collector interface - receives finished, sampled traces"""
+
+    def export(self, trace):
+        raise NotImplementedError
+
+
+class FileSpanExporter(SpanExporter):
+    """Append traces as JSON lines to a local file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        line = json.dumps(trace.to_dict(), default=str)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+class HttpCollectorExporter(SpanExporter):
+    """POST traces to a collector from a background thread so requests never wait on it"""
+
+    def __init__(self, url, max_queue=1000, timeout=2):
+        self.url = url
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._pid = None
+
+    def _ensure_worker(self):
+        # Threads don't survive gunicorn's fork, so start one per worker process
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+            self._thread.start()
+
+    def export(self, trace):
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(trace.to_dict())
+        except queue.Full:
+            logger.warning("Trace exporter queue full, dropping trace")
+
+    def _run(self):
+        while True:
+            payload = self._queue.get()
+            try:
+                req = urllib.request.Request(
+                    self.url,
+                    data=json.dumps(payload, default=str).encode('utf-8'),
+                    headers={'Content-Type': 'application/json'},
+                    method='POST'
+                )
+                urllib.request.urlopen(req, timeout=self.timeout).close()
+            except Exception as e:
+                logger.warning(f"Trace export to collector failed: {e}")
+
+
+class InMemoryExporter(SpanExporter):
+    """Keep traces in a list - local stand-in for a collector"""
+
+    def __init__(self):
+        self.traces = []
+
+    def export(self, trace):
+        self.traces.append(trace.to_dict())
+
+
+class Tracer:
+    """Opens a root span per request and child spans around dependency calls"""
+
+    def __init__(self, exporters=None, sample_rate=TRACE_SAMPLE_RATE, slow_ms=TRACE_SLOW_MS,
+                 enabled=TRACING_ENABLED):
+        self.exporters = list(exporters or [])
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.enabled = enabled
+
+    def init_app(self, app):
+        """Register request hooks and template render spans on a Flask app"""
+        app.before_request(self._start_request)
+        app.after_request(self._tag_response)
+        app.teardown_request(self._finish_request)
+        before_render_template.connect(self._start_template, app, weak=False)
+        template_rendered.connect(self._finish_template, app, weak=False)
+
+    @staticmethod
+    def extract_context(headers):
+        """Get (trace_id, parent_span_id, sampled) from W3C traceparent, nginx or ALB headers"""
+        traceparent = headers.get('traceparent')
+        if traceparent:
+            parts = traceparent.split('-')
+            if len(parts) == 4 and len(parts[1]) == 32:
+                try:
+                    sampled = bool(int(parts[3], 16) & 1)
+                except ValueError:
+                    sampled = False
+                return parts[1], parts[2], sampled
+
+        request_id = headers.get('X-Request-ID')
+        if request_id:
+            return request_id.replace('-', '')[:32], None, False
+
+        amzn_trace = headers.get('X-Amzn-Trace-Id', '')
+        for field in amzn_trace.split(';'):
+            if field.startswith('Root='):
+                # Root=1-<8 hex epoch>-<24 hex id>; the leading "1-" is the format version
+                root = field[len('Root='):]
+                if root.startswith('1-'):
+                    root = root[len('1-'):]
+                return root.replace('-', ''), None, False
+
+        return uuid.uuid4().hex, None, False
+
+    def current_trace(self):
+        if not has_request_context():
+            return None
+        return g.get('_trace')
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time a block as a child of the current span (no-op outside a traced request)"""
+        trace = self.current_trace()
+        if trace is None:
+            yield None
+            return
+
+        parent = trace.stack[-1] if trace.stack else None
+        span = Span(name, trace.trace_id, parent.span_id if parent else None, attributes)
+        trace.spans.append(span)
+        trace.stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.finish()
+            trace.stack.pop()
+
+    def should_keep(self, trace):
+        """Head sampling by rate, plus every request in the latency tail"""
+        return (trace.sampled
+                or trace.root.error is not None
+                or trace.root.attributes.get('http.status', 200) >= 500
+                or trace.root.duration_ms >= self.slow_ms)
+
+    # Request lifecycle hooks
+    def _start_request(self):
+        if not self.enabled:
+            return
+        trace_id, parent_span_id, upstream_sampled = self.extract_context(request.headers)
+        trace = Trace(trace_id, parent_span_id,
+                      sampled=upstream_sampled or random.random() < self.sample_rate)
+        root = Span(f"{request.method} {request.path}", trace_id, parent_span_id, {
+            'http.method': request.method,
+            'http.path': request.path
+        })
+        trace.spans.append(root)
+        trace.stack.append(root)
+        g._trace = trace
+
+    def _tag_response(self, response):
+        trace = self.current_trace()
+        if trace is not None:
+            trace.root.attributes['http.status'] = response.status_code
+            trace.root.attributes['http.route'] = str(request.url_rule) if request.url_rule else None
+            response.headers['X-Trace-Id'] = trace.trace_id
+        return response
+
+    def _finish_request(self, error=None):
+        trace = self.current_trace()
+        if trace is None:
+            return
+        g._trace = None
+        root = trace.root
+        if error is not None:
+            root.error = f"{type(error).__name__}: {error}"
+        for span in trace.stack:
+            if span.duration_ms is None:
+                span.finish()
+
+        if not self.should_keep(trace):
+            return
+        for exporter in self.exporters:
+            try:
+                exporter.export(trace)
+            except Exception as e:
+                logger.warning(f"Trace export failed ({type(exporter).__name__}): {e}")
+
+    def _start_template(self, sender, template, context, **extra):
+        trace = self.current_trace()
+        if trace is None:
+            return
+        parent = trace.stack[-1]
+        span = Span('template.render', trace.trace_id, parent.span_id, {'template': template.name})
+        trace.spans.append(span)
+        trace.stack.append(span)
+
+    def _finish_template(self, sender, template, context, **extra):
+        trace = self.current_trace()
+        if trace is None or len(trace.stack) < 2 or trace.stack[-1].name != 'template.render':
+            return
+        trace.stack.pop().finish()
+
+
+def build_exporters():
+    """Exporters configured through environment variables"""
+    exporters = []
+    if TRACE_EXPORT_FILE:
+        exporters.append(FileSpanExporter(TRACE_EXPORT_FILE))
+    if TRACE_COLLECTOR_URL:
+        exporters.append(HttpCollectorExporter(TRACE_COLLECTOR_URL))
+    if TRACING_ENABLED and not exporters:
+        logger.warning("Tracing enabled but no TRACE_EXPORT_FILE or TRACE_COLLECTOR_URL set")
+    return exporters
+
+
+tracer = Tracer(build_exporters())
+
+
+# Flame-style breakdown
+def folded_stacks(trace):
+    """Convert a trace dict into folded stacks ("root;child;leaf self_ms") for flame graphs"""
+    spans = {span['span_id']: span for span in trace['spans']}
+    child_time = {}
+    for span in trace['spans']:
+        if span['parent_id'] in spans:
+            child_time[span['parent_id']] = child_time.get(span['parent_id'], 0.0) + span['duration_ms']
+
+    lines = []
+    for span in trace['spans']:
+        path = [span['name']]
+        parent_id = span['parent_id']
+        while parent_id in spans:
+            path.append(spans[parent_id]['name'])
+            parent_id = spans[parent_id]['parent_id']
+        self_ms = max(span['duration_ms'] - child_time.get(span['span_id'], 0.0), 0.0)
+        lines.append(f"{';'.join(reversed(path))} {self_ms:.3f}")
+    return lines
+
+
+def format_breakdown(trace):
+    """Indented per-request breakdown of a trace dict"""
+    depth = {}
+    lines = [f"trace {trace['trace_id']} {trace['name']} {trace['duration_ms']:.1f}ms"]
+    for span in trace['spans']:
+        depth[span['span_id']] = depth.get(span['parent_id'], -1) + 1
+        if span['parent_id'] is None or span['parent_id'] == trace.get('parent_span_id'):
+            continue
+        bar = '#' * max(1, int(40 * span['duration_ms'] / max(trace['duration_ms'], 0.001)))
+        error = f"  !! {span['error']}" if span['error'] else ''
+        lines.append(f"{'  ' * depth[span['span_id']]}{span['name']:<30} "
+                     f"+{span['offset_ms']:>8.1f}ms {span['duration_ms']:>8.1f}ms {bar}{error}")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    # Usage: python tracing.py traces.jsonl [--folded]
+    if len(sys.argv) < 2:
+        print("Usage: python tracing.py <trace-file.jsonl> [--folded]")
+        sys.exit(1)
+
+    with open(sys.argv[1]) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            trace = json.loads(line)
+            if '--folded' in sys.argv:
+                print('\n'.join(folded_stacks(trace)))
+            else:
+                print(format_breakdown(trace))
+                print()